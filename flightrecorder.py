@@ -0,0 +1,335 @@
+"""
+Capture messages that are slow to parse, and replay them as a benchmark.
+
+When a message occasionally takes seconds to parse, the input is usually gone
+by the time anyone notices, so there is no telling whether the URL pattern
+backtracked, bracket scrubbing blew up or a title was slow to arrive.
+`FlightRecorder` parses messages just like `message.parse`, and keeps those
+that take longer than a threshold, along with the time spent in each phase of
+parsing and optionally cProfile stats. Captures are kept in a bounded ring
+buffer, and can also be appended to a rotating file as JSON lines:
+
+    recorder = FlightRecorder(threshold=0.5, path='slow.jsonl')
+    recorder.parse(message_text, fetcher=fetcher)
+
+The captured corpus can then be replayed offline, with title retrieval
+answered instantly, as a regression benchmark for the parser itself:
+
+    python flightrecorder.py slow.jsonl --repeat 5 --fail-over 0.1
+"""
+
+from StringIO import StringIO
+from collections import deque
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+import message
+
+
+# Options of `message.parse` that are saved with each capture, so it can be
+# replayed the same way. Fetchers and indexes can't be saved, so replays run
+# without them.
+RECORDED_OPTIONS = (
+    'retrieve_url_titles',
+    'max_mentions',
+    'max_emoticons',
+    'max_links',
+    'max_link_fetches',
+    'index_mode',
+    'mention_prefixes',
+)
+
+
+class RecorderStatistics(message.Counters):
+
+    """
+    Thread-safe counters describing the messages seen by a flight recorder.
+
+    Attributes:
+        messages: messages parsed
+        captured: messages that were slow enough to capture
+    """
+
+    FIELDS = (
+        'messages',
+        'captured',
+    )
+
+
+class FlightRecorder(object):
+
+    """
+    Parse messages, capturing those that are slow to parse.
+
+    Each capture is a dict with the keys:
+        recorded_at -> when the message was parsed, in seconds since the epoch
+        message -> the text of the message
+        options -> the RECORDED_OPTIONS the message was parsed with
+        seconds -> how long parsing took
+        phases -> seconds spent in each phase, as reported by `message.parse`
+        profile -> cProfile stats of the parse, if profiling was enabled
+
+    Args:
+        threshold [float]: seconds a parse must take to be captured
+        capacity [int]: maximum number of captures to keep in memory
+        path [str]: if provided, captures are also appended to this file
+        max_bytes [int]: size the file may grow to before it is rotated to
+            path.1, path.1 to path.2 and so on; 0 never rotates
+        backups [int]: number of rotated files to keep
+        profile [bool]: whether to profile every parse, so that captures
+            include where the time went. This slows parsing down
+            considerably, so is best enabled only while investigating.
+        profile_limit [int]: number of functions listed in each profile
+    """
+
+    def __init__(self, threshold=1.0, capacity=100, path=None,
+                 max_bytes=10 * 1024 * 1024, backups=3, profile=False,
+                 profile_limit=25):
+        self.threshold = threshold
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.profile = profile
+        self.profile_limit = profile_limit
+        self.stats = RecorderStatistics()
+        self._captures = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._captures)
+
+    def captures(self):
+        """
+        Return the captures held in memory, oldest first.
+        """
+        with self._lock:
+            return list(self._captures)
+
+    def clear(self):
+        """
+        Discard the captures held in memory.
+        """
+        with self._lock:
+            self._captures.clear()
+
+    def parse(self, message_text, **kwargs):
+        """
+        Parse a message with `message.parse`, capturing it if it is slow.
+
+        Accepts the same arguments as `message.parse`.
+        """
+        phases = {}
+        profiler = cProfile.Profile() if self.profile else None
+        start = time.time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            result = message.parse(
+                message_text,
+                phase_timings=phases,
+                **kwargs
+            )
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.time() - start
+            self.stats.record(messages=1)
+            if seconds >= self.threshold:
+                self._capture({
+                    'recorded_at': start,
+                    'message': message_text,
+                    'options': {
+                        key: kwargs[key]
+                        for key in RECORDED_OPTIONS
+                        if key in kwargs
+                    },
+                    'seconds': seconds,
+                    'phases': phases,
+                    'profile': (
+                        None if profiler is None
+                        else self._format_profile(profiler)
+                    ),
+                })
+        return result
+
+    def _format_profile(self, profiler):
+        stream = StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(self.profile_limit)
+        return stream.getvalue()
+
+    def _capture(self, capture):
+        if capture['profile'] is None:
+            del capture['profile']
+        if isinstance(capture['message'], str):
+            # JSON can only hold text, so bytes that aren't valid UTF-8 are
+            # replaced rather than losing the capture entirely
+            capture['message'] = capture['message'].decode('utf-8', 'replace')
+        self.stats.record(captured=1)
+        with self._lock:
+            self._captures.append(capture)
+            if self.path is not None:
+                self._write(json.dumps(capture) + '\n')
+
+    def _write(self, line):
+        if (
+            self.max_bytes
+            and
+            os.path.exists(self.path)
+            and
+            os.path.getsize(self.path) + len(line) > self.max_bytes
+        ):
+            self._rotate()
+        with open(self.path, 'a') as capture_file:
+            capture_file.write(line)
+
+    def _rotate(self):
+        for index in xrange(self.backups - 1, 0, -1):
+            backup = '{0}.{1}'.format(self.path, index)
+            if os.path.exists(backup):
+                os.rename(backup, '{0}.{1}'.format(self.path, index + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+
+def load(path):
+    """
+    Load the captures saved to path, including any rotated files.
+
+    Returns:
+        a list of capture dicts, oldest first
+    """
+    paths = [path]
+    index = 1
+    while os.path.exists('{0}.{1}'.format(path, index)):
+        paths.append('{0}.{1}'.format(path, index))
+        index += 1
+    captures = []
+    for capture_path in reversed(paths):
+        if not os.path.exists(capture_path):
+            continue
+        with open(capture_path) as capture_file:
+            captures.extend(
+                json.loads(line) for line in capture_file if line.strip()
+            )
+    return captures
+
+
+class OfflineTitleFetcher(message.TitleFetcher):
+
+    """
+    Answer every title lookup instantly with a blank title.
+
+    Replays use it so that timings reflect the parser rather than whichever
+    servers the captured links point to.
+    """
+
+    def get_title(self, url):
+        return (url, '')
+
+
+def replay(captures, repeat=3):
+    """
+    Parse captured messages again, timing each one.
+
+    Args:
+        captures [list]: captures, as returned by `load` or
+            `FlightRecorder.captures`
+        repeat [int]: number of times to parse each message, at least once;
+            the fastest run is reported, since slower runs only measure
+            interference
+
+    Returns:
+        a list of dicts, one per capture, with the keys:
+            message -> the text of the message
+            recorded_seconds -> how long parsing took when captured
+            seconds -> how long the fastest replay took
+            phases -> seconds spent in each phase during the fastest replay
+
+    Raises:
+        ValueError if repeat is less than 1
+    """
+    if repeat < 1:
+        raise ValueError('repeat must be at least 1')
+    fetcher = OfflineTitleFetcher()
+    results = []
+    for capture in captures:
+        options = {
+            str(key): value for key, value in capture['options'].iteritems()
+        }
+        best = None
+        for _ in xrange(repeat):
+            phases = {}
+            start = time.time()
+            message.parse(
+                capture['message'],
+                fetcher=fetcher,
+                phase_timings=phases,
+                **options
+            )
+            seconds = time.time() - start
+            if best is None or seconds < best[0]:
+                best = (seconds, phases)
+        results.append({
+            'message': capture['message'],
+            'recorded_seconds': capture['seconds'],
+            'seconds': best[0],
+            'phases': best[1],
+        })
+    return results
+
+
+def main(argv=None):
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(
+        description='Replay captured slow messages as a benchmark.',
+    )
+    arg_parser.add_argument('path', help='file the captures were saved to')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--fail-over', type=float, metavar='SECONDS',
+                            help='exit with an error if any message takes '
+                            'longer than this to parse')
+    args = arg_parser.parse_args(argv)
+    if args.repeat < 1:
+        arg_parser.error('--repeat must be at least 1')
+
+    results = replay(load(args.path), repeat=args.repeat)
+    phases = ('mentions', 'emoticons', 'links', 'scrub', 'titles')
+    print '{0:>10} {1:>10} {2} message'.format(
+        'seconds',
+        'recorded',
+        ' '.join('{0:>10}'.format(phase) for phase in phases),
+    )
+    for result in results:
+        print '{0:10.4f} {1:10.4f} {2} {3}'.format(
+            result['seconds'],
+            result['recorded_seconds'],
+            ' '.join(
+                '{0:10.4f}'.format(result['phases'].get(phase, 0))
+                for phase in phases
+            ),
+            repr(result['message'][:40]),
+        )
+    print '{0:10.4f} {1:10.4f} total for {2} messages'.format(
+        sum(result['seconds'] for result in results),
+        sum(result['recorded_seconds'] for result in results),
+        len(results),
+    )
+
+    if args.fail_over is not None and any(
+        result['seconds'] > args.fail_over for result in results
+    ):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
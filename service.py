@@ -0,0 +1,703 @@
+"""
+A long-running HTTP service that parses messages with `message.parse`.
+
+Running one shared service lets many clients benefit from a single warmed-up
+process: the regular expressions are compiled once, and link titles are
+cached across every request. Requests are handled by a fixed pool of worker
+threads, and connections are kept alive so clients can pipeline requests.
+
+Endpoints:
+    POST /parse -> parse a single message. The body is either the raw text
+        of the message, or a JSON object of the form
+        {"message": "...", "options": {...}}. Responds with the parsed
+        message as JSON, exactly as `message.parse_to_json` would.
+    POST /batch -> parse many messages. The body is a JSON object of the form
+        {"messages": ["...", ...], "options": {...}}, and the response is
+        {"results": [...]} with one parsed message per input.
+    GET /health -> {"status": "ok"} while the service is accepting requests
+    GET /metrics -> request, fetch and cache counters as JSON
+
+The options accepted are the keyword arguments of `message.parse` listed in
+PARSE_OPTIONS. Title retrieval always uses the service's shared fetcher.
+
+The service can listen on a TCP port or on a Unix domain socket:
+
+    python service.py --port 8080 --workers 16
+    python service.py --unix-socket /tmp/message.sock
+
+Messages that are slow to parse can be captured for replaying later, see
+`flightrecorder`:
+
+    python service.py --record-slow 0.5 --record-file slow.jsonl
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from Queue import Empty, Queue
+from SocketServer import UnixStreamServer
+import json
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+from flightrecorder import FlightRecorder
+import message
+
+
+# Options clients may pass through to `message.parse`, with their types.
+PARSE_OPTIONS = {
+    'retrieve_url_titles': bool,
+    'max_mentions': int,
+    'max_emoticons': int,
+    'max_links': int,
+    'max_link_fetches': int,
+    'index_mode': basestring,
+    'mention_prefixes': bool,
+}
+
+# Options that only accept certain values.
+PARSE_OPTION_CHOICES = {
+    'index_mode': message.INDEX_MODES,
+}
+
+
+class BadRequest(ValueError):
+
+    """
+    Raised when a client request can't be understood.
+    """
+
+
+class ServiceMetrics(message.Counters):
+
+    """
+    Thread-safe counters describing the requests handled by the service.
+
+    Attributes:
+        requests: HTTP requests handled
+        errors: requests that failed, for any reason
+        messages: messages parsed, including each message in a batch
+        parse_seconds: total time spent parsing messages
+    """
+
+    FIELDS = (
+        'requests',
+        'errors',
+        'messages',
+        'parse_seconds',
+    )
+
+
+class ParseService(object):
+
+    """
+    The state shared by every worker of the service.
+
+    Args:
+        fetcher [message.TitleFetcher]: fetcher used to retrieve titles.
+            Defaults to an HTTPTitleFetcher, wrapped in a
+            CoalescingTitleFetcher and a CachingTitleFetcher configured by
+            the remaining arguments, all sharing a RedirectCache and a
+            DNSCache.
+        url_timeout [float]: timeout in seconds when trying to retrieve links
+        cache_size [int]: maximum number of titles to cache
+        cache_ttl [float]: seconds to cache a title
+        timeouts [message.AdaptiveTimeouts]: if provided, per-host timeouts
+            learned by it are used instead of url_timeout
+        users [message.NameIndex]: if provided, mentions are checked
+            against it
+        emoticon_index [message.NameIndex]: if provided, emoticons are
+            checked against it
+        recorder [flightrecorder.FlightRecorder]: if provided, messages are
+            parsed through it, so that slow ones are captured
+    """
+
+    def __init__(self, fetcher=None, url_timeout=0.5, cache_size=4096,
+                 cache_ttl=300.0, timeouts=None, users=None,
+                 emoticon_index=None, recorder=None):
+        self.users = users
+        self.recorder = recorder
+        self.emoticon_index = emoticon_index
+        self.fetch_stats = message.FetchStatistics()
+        self.timeouts = timeouts
+        self.redirects = None
+        self.dns_cache = None
+        if fetcher is None:
+            self.redirects = message.RedirectCache()
+            self.dns_cache = message.DNSCache()
+            fetcher = message.CachingTitleFetcher(
+                message.CoalescingTitleFetcher(
+                    message.HTTPTitleFetcher(
+                        timeout=url_timeout,
+                        stats=self.fetch_stats,
+                        timeouts=timeouts,
+                        redirects=self.redirects,
+                        dns_cache=self.dns_cache,
+                    ),
+                ),
+                max_entries=cache_size,
+                ttl=cache_ttl,
+                redirects=self.redirects,
+            )
+        self.fetcher = fetcher
+        self.metrics = ServiceMetrics()
+        self.started = time.time()
+
+    @staticmethod
+    def clean_options(options):
+        """
+        Validate options supplied by a client.
+
+        Raises:
+            BadRequest if an option is unknown or has the wrong type
+        """
+        if not isinstance(options, dict):
+            raise BadRequest('options must be an object')
+        for key, value in options.iteritems():
+            expected_type = PARSE_OPTIONS.get(key)
+            if expected_type is None:
+                raise BadRequest('unknown option: {0}'.format(key))
+            # bool is a subclass of int, but True is not a sensible limit
+            if (
+                not isinstance(value, expected_type)
+                or
+                (expected_type is int and isinstance(value, bool))
+            ):
+                raise BadRequest('invalid value for option: {0}'.format(key))
+            if value not in PARSE_OPTION_CHOICES.get(key, (value,)):
+                raise BadRequest('invalid value for option: {0}'.format(key))
+            if expected_type is int and value < 0:
+                raise BadRequest(
+                    'option must not be negative: {0}'.format(key)
+                )
+        return {str(key): value for key, value in options.iteritems()}
+
+    def parse(self, message_text, **options):
+        start = time.time()
+        parse = message.parse
+        if self.recorder is not None:
+            parse = self.recorder.parse
+        result = parse(
+            message_text,
+            fetcher=self.fetcher,
+            users=self.users,
+            emoticon_index=self.emoticon_index,
+            **options
+        )
+        self.metrics.record(messages=1, parse_seconds=time.time() - start)
+        return result
+
+    def batch(self, messages, **options):
+        if (
+            options == {'retrieve_url_titles': False}
+            and
+            self.users is None
+            and
+            self.emoticon_index is None
+            and
+            self.recorder is None
+        ):
+            # without titles, limits or indexes, the batch scanner gives
+            # identical results faster. It can't time messages individually
+            # though, so isn't used while recording slow ones.
+            start = time.time()
+            results = message.parse_batch(messages)
+            self.metrics.record(
+                messages=len(messages),
+                parse_seconds=time.time() - start,
+            )
+            return results
+        return [self.parse(message_text, **options) for message_text in messages]
+
+    def snapshot(self):
+        """
+        Return all of the service's metrics as a dict.
+        """
+        snapshot = {
+            'uptime': time.time() - self.started,
+            'service': self.metrics.as_dict(),
+            'fetch': self.fetch_stats.as_dict(),
+        }
+        # report the counters of each layer of wrapped fetchers
+        fetcher = self.fetcher
+        while fetcher is not None:
+            stats = getattr(fetcher, 'stats', None)
+            if isinstance(stats, message.CacheStatistics):
+                snapshot['cache'] = dict(stats.as_dict(), entries=len(fetcher))
+            elif isinstance(stats, message.CoalescingStatistics):
+                snapshot['coalescing'] = stats.as_dict()
+            fetcher = getattr(fetcher, 'fetcher', None)
+        if self.redirects is not None:
+            snapshot['redirects'] = dict(
+                self.redirects.stats.as_dict(),
+                entries=len(self.redirects),
+            )
+        if self.dns_cache is not None:
+            snapshot['dns'] = dict(
+                self.dns_cache.stats.as_dict(),
+                entries=len(self.dns_cache),
+            )
+        if self.timeouts is not None:
+            snapshot['timeouts'] = {'hosts': len(self.timeouts)}
+        if self.recorder is not None:
+            snapshot['recorder'] = dict(
+                self.recorder.stats.as_dict(),
+                entries=len(self.recorder),
+            )
+        return snapshot
+
+
+class ParseRequestHandler(BaseHTTPRequestHandler):
+
+    """
+    Translate HTTP requests into calls on the server's ParseService.
+    """
+
+    # HTTP/1.1 keeps connections open between requests, which is what allows
+    # clients to pipeline them.
+    protocol_version = 'HTTP/1.1'
+    # give up on clients that stall partway through a request
+    timeout = 15
+
+    def __init__(self, request, client_address, server):
+        # Unlike BaseHTTPRequestHandler, don't handle the connection's
+        # requests here. The server's workers call handle_one_request as each
+        # request arrives, so that idle connections don't tie up a worker.
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def has_buffered_request(self):
+        """
+        Return whether data read ahead from the client, such as a pipelined
+        request, is waiting to be handled.
+        """
+        # socket._fileobject keeps this in a private buffer, where select
+        # can't see it
+        buffered = self.rfile._rbuf
+        buffered.seek(0, 2)
+        return buffered.tell() > 0
+
+    def address_string(self):
+        # Unix domain socket clients don't have a (host, port) address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._handle(lambda: {'status': 'ok'})
+        elif self.path == '/metrics':
+            self._handle(self.server.service.snapshot)
+        else:
+            self._handle(None)
+
+    def do_POST(self):
+        if self.path == '/parse':
+            self._handle(self._parse)
+        elif self.path == '/batch':
+            self._handle(self._batch)
+        else:
+            self._handle(None)
+
+    def _read_body(self):
+        try:
+            length = int(self.headers.getheader('Content-Length', 0))
+        except ValueError:
+            raise BadRequest('invalid Content-Length')
+        return self.rfile.read(length)
+
+    def _read_json(self):
+        try:
+            body = json.loads(self._read_body())
+        except ValueError:
+            raise BadRequest('body is not valid JSON')
+        if not isinstance(body, dict):
+            raise BadRequest('body must be a JSON object')
+        return body
+
+    def _parse(self):
+        content_type = self.headers.gettype()
+        service = self.server.service
+        if content_type != 'application/json':
+            return service.parse(self._read_body())
+        body = self._read_json()
+        message_text = body.get('message')
+        if not isinstance(message_text, basestring):
+            raise BadRequest('message must be a string')
+        options = service.clean_options(body.get('options', {}))
+        return service.parse(message_text, **options)
+
+    def _batch(self):
+        service = self.server.service
+        body = self._read_json()
+        messages = body.get('messages')
+        if (
+            not isinstance(messages, list)
+            or
+            not all(isinstance(text, basestring) for text in messages)
+        ):
+            raise BadRequest('messages must be a list of strings')
+        options = service.clean_options(body.get('options', {}))
+        return {'results': service.batch(messages, **options)}
+
+    def _handle(self, handler):
+        metrics = self.server.service.metrics
+        metrics.record(requests=1)
+        if handler is None:
+            status, result = 404, {'error': 'not found'}
+        else:
+            try:
+                status, result = 200, handler()
+            except BadRequest as e:
+                status, result = 400, {'error': str(e)}
+            except Exception as e:
+                self.log_error('error handling %s: %r', self.path, e)
+                status, result = 500, {'error': 'internal error'}
+        if status != 200:
+            metrics.record(errors=1)
+            # we may not have consumed the body, so the connection can't be
+            # reused for another request
+            self.close_connection = 1
+        self._send_json(status, result)
+
+    def _send_json(self, status, result):
+        body = json.dumps(result)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class WorkerPoolMixIn(object):
+
+    """
+    Handle HTTP requests with a fixed pool of worker threads.
+
+    Unlike ThreadingMixIn, which ties up a thread for as long as each
+    connection is open, a worker is only busy with a connection while it
+    handles a request. New connections, and kept-alive ones between
+    requests, are watched by a single thread with poll, and only queued for
+    the workers once a request arrives. Connections left idle for
+    idle_timeout seconds are closed.
+
+    RequestHandlerClass must set up the connection when created, and handle
+    a request each time handle_one_request is called, like
+    ParseRequestHandler.
+    """
+
+    workers = 8
+    idle_timeout = 15
+
+    def start_workers(self):
+        # Connections ready to be handled, as (request, client address,
+        # handler or None if not yet set up). This is unbounded, since the
+        # workers put connections with pipelined requests back on it, and
+        # would deadlock if they blocked on a full queue. Only connections
+        # that are open and have a request waiting are queued, so the
+        # number of connections still bounds it.
+        self._queue = Queue()
+        # connections waiting for their first or next request
+        self._idle = Queue()
+        self._stopping = threading.Event()
+        self._wake_read, self._wake_write = os.pipe()
+        self._watcher = threading.Thread(target=self._watch_idle)
+        self._watcher.daemon = True
+        self._watcher.start()
+        self._workers = []
+        for _ in xrange(self.workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop_workers(self):
+        self._stopping.set()
+        self._wake()
+        self._watcher.join()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        # a worker may have parked a connection as the watcher stopped
+        self._close_idle()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def process_request(self, request, client_address):
+        # wait for the first request in the watcher too, so that clients
+        # which connect without sending anything don't tie up a worker
+        self._idle.put((request, client_address, None))
+        self._wake()
+
+    def _wake(self):
+        os.write(self._wake_write, 'x')
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address, handler = item
+            try:
+                if handler is None:
+                    handler = self.RequestHandlerClass(
+                        request,
+                        client_address,
+                        self,
+                    )
+                handler.close_connection = 1
+                handler.handle_one_request()
+            except Exception:
+                self.handle_error(request, client_address)
+                self._close((request, client_address, handler))
+                continue
+            item = (request, client_address, handler)
+            if handler.close_connection or self._stopping.is_set():
+                self._close(item)
+            elif handler.has_buffered_request():
+                self._queue.put(item)
+            else:
+                self._idle.put(item)
+                self._wake()
+
+    def _watch_idle(self):
+        poller = select.poll()
+        poller.register(self._wake_read, select.POLLIN)
+        # file descriptor -> (deadline, queue item)
+        idle = {}
+        while not self._stopping.is_set():
+            while True:
+                try:
+                    item = self._idle.get_nowait()
+                except Empty:
+                    break
+                fd = item[0].fileno()
+                idle[fd] = (time.time() + self.idle_timeout, item)
+                poller.register(fd, select.POLLIN)
+            try:
+                events = poller.poll(500)
+            except select.error:
+                continue
+            for fd, _ in events:
+                if fd == self._wake_read:
+                    os.read(self._wake_read, 4096)
+                    continue
+                poller.unregister(fd)
+                self._queue.put(idle.pop(fd)[1])
+            now = time.time()
+            for fd, (deadline, item) in idle.items():
+                if deadline <= now:
+                    poller.unregister(fd)
+                    del idle[fd]
+                    self._close(item)
+        for _, item in idle.itervalues():
+            self._close(item)
+        self._close_idle()
+
+    def _close_idle(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except Empty:
+                return
+
+    def _close(self, item):
+        request, client_address, handler = item
+        try:
+            if handler is not None:
+                handler.finish()
+        except socket.error:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        # clients disconnecting isn't worth a traceback
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        super(WorkerPoolMixIn, self).handle_error(request, client_address)
+
+
+class _ServerMixIn(WorkerPoolMixIn):
+
+    """
+    Lifecycle shared by the TCP and Unix domain socket servers.
+    """
+
+    def _setup(self, service, workers, verbose):
+        self.service = service if service is not None else ParseService()
+        self.workers = workers
+        self.verbose = verbose
+        self._thread = None
+        self.start_workers()
+
+    def start(self):
+        """
+        Serve requests on a background thread.
+        """
+        self._thread = threading.Thread(
+            target=self.serve_forever,
+            kwargs={'poll_interval': 0.05},
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving, waiting for in-progress requests to finish.
+        """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+        self.stop_workers()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class ParseHTTPServer(_ServerMixIn, HTTPServer):
+
+    """
+    Serve a ParseService over TCP.
+
+    Args:
+        address [tuple]: (host, port) to listen on; port 0 picks a free port
+        service [ParseService]: the service to expose; a default one is
+            created if omitted
+        workers [int]: number of worker threads
+        verbose [bool]: whether to log each request to stderr
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 8080), service=None, workers=8,
+                 verbose=False):
+        HTTPServer.__init__(self, address, ParseRequestHandler)
+        self._setup(service, workers, verbose)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+
+class ParseUnixServer(_ServerMixIn, UnixStreamServer):
+
+    """
+    Serve a ParseService over a Unix domain socket.
+
+    Takes the same arguments as ParseHTTPServer, except that the address is
+    the path of the socket. Any stale socket file at that path is replaced.
+    """
+
+    def __init__(self, path, service=None, workers=8, verbose=False):
+        if os.path.exists(path):
+            os.unlink(path)
+        UnixStreamServer.__init__(self, path, ParseRequestHandler)
+        self._setup(service, workers, verbose)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def main(argv=None):
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--unix-socket', help='listen on this socket path '
+                            'instead of a TCP port')
+    arg_parser.add_argument('--workers', type=int, default=8)
+    arg_parser.add_argument('--url-timeout', type=float, default=0.5)
+    arg_parser.add_argument('--cache-size', type=int, default=4096)
+    arg_parser.add_argument('--cache-ttl', type=float, default=300.0)
+    arg_parser.add_argument('--timeouts-file', help='learn per-host timeouts, '
+                            'loading them from and saving them to this file')
+    arg_parser.add_argument('--users-file', help='check mentions against '
+                            'the users in this file, one per line')
+    arg_parser.add_argument('--emoticons-file', help='check emoticons '
+                            'against the names in this file, one per line')
+    arg_parser.add_argument('--record-slow', type=float, metavar='SECONDS',
+                            help='capture messages that take longer than '
+                            'this to parse')
+    arg_parser.add_argument('--record-file', help='append captured messages '
+                            'to this file, to replay with flightrecorder.py')
+    arg_parser.add_argument('--record-profile', action='store_true',
+                            help='include cProfile stats in captures')
+    arg_parser.add_argument('--quiet', action='store_true')
+    args = arg_parser.parse_args(argv)
+
+    timeouts = None
+    if args.timeouts_file:
+        timeouts = message.AdaptiveTimeouts(default_timeout=args.url_timeout)
+        if os.path.exists(args.timeouts_file):
+            timeouts.load(args.timeouts_file)
+    users = emoticon_index = None
+    if args.users_file:
+        users = message.NameIndex.load(args.users_file)
+    if args.emoticons_file:
+        emoticon_index = message.NameIndex.load(args.emoticons_file)
+    recorder = None
+    if args.record_slow is not None:
+        recorder = FlightRecorder(
+            threshold=args.record_slow,
+            path=args.record_file,
+            profile=args.record_profile,
+        )
+    service = ParseService(
+        url_timeout=args.url_timeout,
+        cache_size=args.cache_size,
+        cache_ttl=args.cache_ttl,
+        timeouts=timeouts,
+        users=users,
+        emoticon_index=emoticon_index,
+        recorder=recorder,
+    )
+    if args.unix_socket:
+        server = ParseUnixServer(
+            args.unix_socket,
+            service,
+            workers=args.workers,
+            verbose=not args.quiet,
+        )
+        print 'Serving on {0}'.format(args.unix_socket)
+    else:
+        server = ParseHTTPServer(
+            (args.host, args.port),
+            service,
+            workers=args.workers,
+            verbose=not args.quiet,
+        )
+        print 'Serving on {0}'.format(server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop_workers()
+        server.server_close()
+        if timeouts is not None:
+            timeouts.save(args.timeouts_file)
+
+
+if __name__ == '__main__':
+    main()
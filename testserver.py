@@ -0,0 +1,311 @@
+"""
+A local HTTP stand-in for the web servers `message` retrieves titles from.
+
+Title fetching depends on whatever is on the other end of each link, which
+makes concurrency, timeout and caching behavior hard to exercise reliably
+against the real internet. `StandInServer` serves HTML documents from
+localhost, with knobs to simulate the ways real servers misbehave:
+
+    latency -> seconds to wait before sending the response
+    bandwidth -> maximum bytes per second to send the body at
+    status -> HTTP status code of the response
+    redirect -> location to redirect to (with a 302 unless status is set)
+    title -> title embedded in the generated HTML document
+    body -> literal body to send instead of a generated document
+    padding -> number of filler bytes to append after the title, to
+        simulate huge documents
+    encoding -> 'gzip' or 'deflate' to compress the body
+    hang -> seconds to stall before responding; a negative value stalls
+        until the server is stopped
+
+Behavior can be configured per path with `add_route`, or per request by
+passing the knobs as query parameters, e.g. /slow?latency=2&title=Slow
+
+The server can be used as a context manager from tests, or run from the
+command line for ad hoc load testing:
+
+    python testserver.py --port 8000 --latency 0.25
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from cgi import escape
+from collections import Counter
+import socket
+import sys
+import threading
+from urlparse import parse_qsl, urlsplit
+import zlib
+
+
+# Knobs that may be supplied as query parameters, with the functions used to
+# convert them from strings.
+ROUTE_OPTIONS = {
+    'latency': float,
+    'bandwidth': int,
+    'status': int,
+    'redirect': str,
+    'title': str,
+    'body': str,
+    'padding': int,
+    'encoding': str,
+    'hang': float,
+}
+
+_FILLER = 'All work and no play makes Jack a dull boy. '
+
+
+def build_document(title, padding=0):
+    """
+    Build an HTML document with the given title and padding bytes of filler.
+    """
+    filler = (_FILLER * (padding // len(_FILLER) + 1))[:padding]
+    return '<html><head><title>{0}</title></head><body>{1}</body></html>'.format(
+        escape(title),
+        filler,
+    )
+
+
+def compress(data, encoding):
+    """
+    Compress data according to the HTTP content coding given.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS)
+    else:
+        raise ValueError('unsupported encoding: {0}'.format(encoding))
+    return compressor.compress(data) + compressor.flush()
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+
+    """
+    Serve a response shaped by the route options for the requested path.
+    """
+
+    protocol_version = 'HTTP/1.0'
+    # don't let idle connections keep the server from stopping
+    timeout = 5
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        options = self.server.options_for(self.path)
+        self.server.record_hit(path)
+        self._respond(options)
+
+    def _respond(self, options):
+        hang = options.get('hang')
+        if hang is not None:
+            self.server.stopping.wait(None if hang < 0 else hang)
+            if self.server.stopping.is_set():
+                return
+
+        latency = options.get('latency')
+        if latency and self.server.stopping.wait(latency):
+            return
+
+        redirect = options.get('redirect')
+        status = options.get('status') or (302 if redirect else 200)
+        body = options.get('body')
+        if body is None:
+            body = build_document(
+                options.get('title', self.server.default_title),
+                options.get('padding', 0),
+            )
+        encoding = options.get('encoding')
+        if encoding:
+            body = compress(body, encoding)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if redirect:
+            self.send_header('Location', redirect)
+        self.end_headers()
+        self._write_body(body, options.get('bandwidth'))
+
+    def _write_body(self, body, bandwidth):
+        # when throttled, send ten slices per second to approximate the
+        # requested rate
+        slice_size = max(bandwidth // 10, 1) if bandwidth else 65536
+        for offset in xrange(0, len(body), slice_size):
+            if self.server.stopping.is_set():
+                return
+            self.wfile.write(body[offset:offset + slice_size])
+            if bandwidth:
+                self.wfile.flush()
+                self.server.stopping.wait(0.1)
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+
+    """
+    Threaded local HTTP server with configurable misbehavior.
+
+    Args:
+        host [str]: interface to listen on
+        port [int]: port to listen on; 0 picks a free port
+        default_options [dict]: route options applied to every request
+            unless overridden by a route or the query string
+        default_title [str]: title of generated documents
+        verbose [bool]: whether to log each request to stderr
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # generous, so load tests aren't limited by the listen backlog
+    request_queue_size = 128
+
+    def __init__(self, host='127.0.0.1', port=0, default_options=None,
+                 default_title='Stand-in', verbose=False):
+        HTTPServer.__init__(self, (host, port), StandInRequestHandler)
+        self.default_options = dict(default_options or {})
+        self.default_title = default_title
+        self.verbose = verbose
+        self.routes = {}
+        self.hits = Counter()
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._active_requests = 0
+        self._thread = None
+
+    def process_request_thread(self, request, client_address):
+        with self._lock:
+            self._active_requests += 1
+        try:
+            ThreadingMixIn.process_request_thread(
+                self,
+                request,
+                client_address,
+            )
+        finally:
+            with self._lock:
+                self._active_requests -= 1
+                self._idle.notify_all()
+
+    def add_route(self, path, **options):
+        """
+        Configure the behavior of requests for path with ROUTE_OPTIONS.
+        """
+        unknown = set(options) - set(ROUTE_OPTIONS)
+        if unknown:
+            raise TypeError(
+                'unknown route options: {0}'.format(', '.join(sorted(unknown)))
+            )
+        self.routes[path] = options
+
+    def options_for(self, request_path):
+        """
+        Resolve the route options for a request path including query string.
+        """
+        split = urlsplit(request_path)
+        options = dict(self.default_options)
+        options.update(self.routes.get(split.path, {}))
+        for key, value in parse_qsl(split.query):
+            if key in ROUTE_OPTIONS:
+                options[key] = ROUTE_OPTIONS[key](value)
+        return options
+
+    def handle_error(self, request, client_address):
+        # clients routinely hang up once they have the title
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    def record_hit(self, path):
+        with self._lock:
+            self.hits[path] += 1
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def url(self, path='/', **options):
+        """
+        Build a URL on this server, with options encoded in the query string.
+        """
+        query = '&'.join(
+            '{0}={1}'.format(key, value)
+            for key, value in sorted(options.iteritems())
+        )
+        return self.base_url + path + ('?' + query if query else '')
+
+    def start(self):
+        """
+        Serve requests on a background thread.
+        """
+        self._thread = threading.Thread(
+            target=self.serve_forever,
+            kwargs={'poll_interval': 0.05},
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving, releasing any requests that are hanging.
+        """
+        self.stopping.set()
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+        with self._lock:
+            while self._active_requests:
+                self._idle.wait()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main(argv=None):
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8000)
+    arg_parser.add_argument('--title', default='Stand-in')
+    arg_parser.add_argument('--quiet', action='store_true')
+    for option, convert in sorted(ROUTE_OPTIONS.iteritems()):
+        if option != 'title':
+            arg_parser.add_argument('--' + option, type=convert)
+    args = arg_parser.parse_args(argv)
+
+    default_options = {
+        option: getattr(args, option)
+        for option in ROUTE_OPTIONS
+        if option != 'title' and getattr(args, option) is not None
+    }
+    server = StandInServer(
+        args.host,
+        args.port,
+        default_options=default_options,
+        default_title=args.title,
+        verbose=not args.quiet,
+    )
+    print 'Serving on {0}'.format(server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stopping.set()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()